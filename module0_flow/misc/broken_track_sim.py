@@ -208,10 +208,18 @@ class BrokenTrackSim(H5FlowStage):
             d = self.apply_translation(hits, rand_x, rand_y)
             trans_hits = d['trans_hits']
 
-            track_ids = self.reco.find_tracks(trans_hits, hit_drift['z'])
-            new_tracks = self.reco.calc_tracks(trans_hits, hit_drift['z'], track_ids,
+            hit_mask = ~trans_hits['id'].mask
+            hit_offsets = self.reco.hit_offsets(hit_mask)
+            trans_xyz = self.reco.hit_xyz(ma.getdata(trans_hits)[hit_mask], ma.getdata(hit_drift['z'])[hit_mask],
+                                          dtype=np.float32)
+            hit_track_ids = self.reco.find_tracks(trans_xyz, hit_offsets)
+            new_tracks = self.reco.calc_tracks(ma.getdata(trans_hits)[hit_mask], trans_xyz,
+                                               hit_track_ids, hit_offsets,
                                                self.trajectory_pts,
                                                self.trajectory_dx)
+            track_ids = ma.array(np.full(hit_mask.shape, -1, dtype=hit_track_ids.dtype), mask=~hit_mask,
+                                 shrink=False)
+            track_ids[hit_mask] = hit_track_ids
 
             d = self.find_matching_tracks(new_tracks, rand_tracks, rand_x, rand_y,
                                           track_ids, hits_track_idx)
@@ -235,10 +235,16 @@ class TrackletMerger(H5FlowStage):
 
             # recalculate track parameters
             calc_shape = (track_grp_id.shape[0], -1)
+            hit_mask = ~track_grp_hits_mask.reshape(calc_shape)
+            calc_hits = ma.getdata(track_grp_hits).reshape(calc_shape)[hit_mask]
+            calc_xyz = TrackletReconstruction.hit_xyz(
+                calc_hits, ma.getdata(track_grp_hit_drift['z']).reshape(calc_shape)[hit_mask],
+                dtype=np.float32)
             merged_tracks = TrackletReconstruction.calc_tracks(
-                track_grp_hits.reshape(calc_shape), track_grp_hit_drift['z'].reshape(calc_shape),
-                track_grp_id.reshape(calc_shape), self.trajectory_pts,
-                self.trajectory_dx)
+                calc_hits, calc_xyz,
+                ma.getdata(track_grp_id).reshape(calc_shape)[hit_mask],
+                TrackletReconstruction.hit_offsets(hit_mask),
+                self.trajectory_pts, self.trajectory_dx)
         else:
             merged_tracks = ma.masked_all((0, 1), dtype=self.merged_dtype)
             track_grp = ma.masked_all((0, 1, 1), dtype=bool)
@@ -1,12 +1,195 @@
+import logging
+
 import numpy as np
 import numpy.ma as ma
+import numba as nb
 
-import sklearn.cluster as cluster
-import sklearn.decomposition as dcomp
-from skimage.measure import LineModelND, ransac
+from scipy.spatial import cKDTree
 
 from h5flow.core import H5FlowStage, resources
 
+try:
+    import cupy as cp
+    import cuml
+except ImportError:
+    cp = None
+    cuml = None
+
+
+def make_dbscan_kernel(min_samples):
+    '''
+        Compiles a DBSCAN kernel with ``min_samples`` as a compile-time
+        constant. The kernel runs on a precomputed radius-neighbor graph and
+        is equivalent to ``sklearn.cluster.DBSCAN(min_samples=min_samples)``
+        run separately on each group of positions. Edges between positions in
+        different groups are ignored.
+
+        :param min_samples: ``int``, min neighbor points (including self) to consider as "core" point
+
+        :returns: compiled function ``(indptr, indices, group) -> labels``,
+            where ``indptr`` ``shape: (N+1,)`` and ``indices`` ``shape: (E,)``
+            are the CSR neighbor graph (excluding self), ``group``
+            ``shape: (N,)`` is the group index of each position (``-1`` to
+            exclude the position), and ``labels`` ``shape: (N,)`` are the
+            cluster labels (numbered from 0 within each group, ``-1`` for noise)
+    '''
+    min_samples = int(min_samples)
+
+    @nb.njit('i8[:](i8[:], i8[:], i8[:])', cache=True)
+    def dbscan_graph(indptr, indices, group):
+        n = group.shape[0]
+
+        is_core = np.zeros(n, dtype=np.bool_)
+        for i in range(n):
+            if group[i] == -1:
+                continue
+            n_neighbors = 1
+            for jj in range(indptr[i], indptr[i + 1]):
+                if group[indices[jj]] == group[i]:
+                    n_neighbors += 1
+            is_core[i] = n_neighbors >= min_samples
+
+        n_groups = 0
+        for i in range(n):
+            n_groups = max(n_groups, group[i] + 1)
+
+        labels = np.full(n, -1, dtype=np.int64)
+        next_label = np.zeros(n_groups, dtype=np.int64)
+        stack = np.empty(n, dtype=np.int64)
+        for i in range(n):
+            if labels[i] != -1 or not is_core[i]:
+                continue
+
+            # expand cluster from seed point
+            label = next_label[group[i]]
+            next_label[group[i]] += 1
+            labels[i] = label
+            stack[0] = i
+            top = 1
+            while top > 0:
+                top -= 1
+                k = stack[top]
+                if not is_core[k]:
+                    continue
+                for jj in range(indptr[k], indptr[k + 1]):
+                    j = indices[jj]
+                    if labels[j] != -1 or group[j] != group[k]:
+                        continue
+                    labels[j] = label
+                    stack[top] = j
+                    top += 1
+        return labels
+
+    return dbscan_graph
+
+
+def make_line_ransac_kernel(min_samples, residual_threshold, max_trials,
+                            stop_inlier_frac=0.95, stop_probability=0.99):
+    '''
+        Compiles a 3D line RANSAC kernel with the fit parameters as
+        compile-time constants. The kernel is equivalent to
+        ``skimage.measure.ransac`` with ``skimage.measure.LineModelND``: the
+        trial with the most inliers (then the smallest sum of squared
+        residuals) is selected. Trials stop early once the best trial contains
+        ``stop_inlier_frac`` of the positions, or once enough trials have been
+        run to find an outlier-free sample with ``stop_probability`` given the
+        current inlier fraction.
+
+        :param min_samples: ``int``, number of positions to fit in each trial
+
+        :param residual_threshold: ``float``, max distance from trial axis to be an inlier
+
+        :param max_trials: ``int``, max number of trials
+
+        :param stop_inlier_frac: ``float``, fraction of inliers to stop trials
+
+        :param stop_probability: ``float``, confidence of outlier-free sample to stop trials
+
+        :returns: compiled function ``(xyz) -> inliers``, where ``xyz``
+            ``shape: (N,3)`` are 3D positions and ``inliers`` ``shape: (N,)``
+            is a boolean array of the inliers of the best trial
+    '''
+    min_samples = int(min_samples)
+    residual_threshold2 = float(residual_threshold) ** 2
+    max_trials = int(max_trials)
+    stop_inlier_frac = float(stop_inlier_frac)
+    log_stop_probability = float(np.log(1 - stop_probability))
+
+    @nb.njit('b1[:](f8[:,:])', cache=True)
+    def line_ransac(xyz):
+        n = xyz.shape[0]
+        best_n_inliers = -1
+        best_residual_sum = np.inf
+        best_origin = np.zeros(3)
+        best_direction = np.zeros(3)
+
+        n_trials = max_trials
+        i_trial = 0
+        while i_trial < n_trials:
+            i_trial += 1
+            sample = xyz[np.random.choice(n, min_samples, replace=False)]
+
+            # fit line to sample
+            origin = sample.sum(axis=0) / min_samples
+            if min_samples == 2:
+                direction = sample[1] - sample[0]
+            else:
+                _, _, vh = np.linalg.svd(sample - origin)
+                direction = vh[0].copy()
+            # (coincident samples keep a zero direction, as in LineModelND)
+            norm = np.sqrt(np.sum(direction ** 2))
+            if norm != 0:
+                direction /= norm
+
+            # score trial
+            n_inliers = 0
+            residual_sum = 0.
+            for i in range(n):
+                d = xyz[i] - origin
+                s = np.sum(d * direction)
+                res2 = np.sum((d - s * direction) ** 2)
+                residual_sum += res2
+                if res2 < residual_threshold2:
+                    n_inliers += 1
+
+            if (n_inliers > best_n_inliers
+                    or (n_inliers == best_n_inliers and residual_sum < best_residual_sum)):
+                best_n_inliers = n_inliers
+                best_residual_sum = residual_sum
+                best_origin = origin
+                best_direction = direction
+
+                # stop early if further trials are unlikely to improve the fit
+                if n_inliers >= stop_inlier_frac * n:
+                    break
+                # (clamp before casting, 1 - p_good rounds to 1 for small p_good)
+                p_good = (n_inliers / n) ** min_samples
+                denom = np.log1p(-p_good)
+                if denom < 0:
+                    n_trials = min(n_trials, int(np.ceil(min(log_stop_probability / denom, max_trials))))
+
+        inliers = np.zeros(n, dtype=np.bool_)
+        if best_n_inliers < 0:
+            return inliers
+        for i in range(n):
+            d = xyz[i] - best_origin
+            s = np.sum(d * best_direction)
+            inliers[i] = np.sum((d - s * best_direction) ** 2) < residual_threshold2
+        return inliers
+
+    return line_ransac
+
+
+def _cluster_ids(labels):
+    '''
+        :param labels: ``shape: (N,)`` array of non-negative cluster labels, ``-1`` for unclustered positions
+
+        :returns: ``tuple`` of ``shape: (n,)`` cluster labels present and ``shape: (n,)`` number of positions with each label
+    '''
+    counts = np.bincount(labels + 1)[1:]
+    ids = np.flatnonzero(counts)
+    return ids, counts[ids]
+
 
 class TrackletReconstruction(H5FlowStage):
     '''
@@ -22,12 +205,24 @@ class TrackletReconstruction(H5FlowStage):
          - ``dbscan_min_samples``: ``int``, dbscan min neighbor points to consider as "core" point
          - ``ransac_min_samples``: ``int``, min points to run ransac algorithm
          - ``ransac_residual_threshold``: ``float``, max distance from trial axis
-         - ``ransac_max_trials``: ``int``, number of ransac trials per cluster
+         - ``ransac_max_trials``: ``int``, max number of ransac trials per cluster
+         - ``ransac_stop_inlier_frac``: ``float``, stop ransac trials once this fraction of the cluster are inliers
+         - ``ransac_stop_probability``: ``float``, confidence of an outlier-free trial to stop ransac trials
+         - ``ransac_min_nhit``: ``int``, fit clusters with fewer hits directly without ransac
+         - ``ransac_collinear_ratio``: ``float``, skip ransac if principal variance is this many times the remaining variance
          - ``max_iterations``: ``int``, max number of fitting iterations before giving up
          - ``max_nhit``: ``int``, skip track fitting on events with greater number of hits, ``None`` to apply no cut
+         - ``use_gpu_dbscan``: ``bool``, run DBSCAN on the GPU with ``cuml`` for large chunks (requires ``cupy`` and ``cuml``)
+         - ``gpu_dbscan_min_nhit``: ``int``, min number of hits in a chunk to run DBSCAN on the GPU
 
         Both ``hits_dset_name`` and ``hits_drift_dset_name`` are required in the cache.
 
+        The ``dbscan_eps`` neighbors of each hit are found once per chunk
+        using a KD-tree and are shared by all DBSCAN passes. If
+        ``use_gpu_dbscan`` is set, chunks with at least
+        ``gpu_dbscan_min_nhit`` hits are instead copied to the GPU once and
+        each DBSCAN pass is run with ``cuml.cluster.DBSCAN``.
+
         Requires Geometry, RunData, and Units resource in workflow.
 
         ``tracklets`` datatype::
@@ -52,7 +247,7 @@ class TrackletReconstruction(H5FlowStage):
             dn                  i8(trajectory_pts-1,)       nhit along track displacement
 
     '''
-    class_version = '1.0.0'
+    class_version = '1.1.0'
 
     default_tracklet_dset_name = 'combined/tracklets'
     default_hits_dset_name = 'charge/hits'
@@ -63,10 +258,16 @@ class TrackletReconstruction(H5FlowStage):
     default_ransac_min_samples = 2
     default_ransac_residual_threshold = 8
     default_ransac_max_trials = 100
+    default_ransac_stop_inlier_frac = 0.95
+    default_ransac_stop_probability = 0.99
+    default_ransac_min_nhit = 6
+    default_ransac_collinear_ratio = 50
     default_max_iterations = 100
     default_trajectory_pts = 5
     default_trajectory_dx = 10
     default_max_nhit = 3000
+    default_use_gpu_dbscan = False
+    default_gpu_dbscan_min_nhit = 50000
 
     @staticmethod
     def tracklet_dtype(npts=default_trajectory_pts):
@@ -97,14 +298,28 @@ class TrackletReconstruction(H5FlowStage):
         self._ransac_min_samples = params.get('ransac_min_samples', self.default_ransac_min_samples)
         self._ransac_residual_threshold = params.get('ransac_residual_threshold', self.default_ransac_residual_threshold)
         self._ransac_max_trials = params.get('ransac_max_trials', self.default_ransac_max_trials)
+        self._ransac_stop_inlier_frac = params.get('ransac_stop_inlier_frac', self.default_ransac_stop_inlier_frac)
+        self._ransac_stop_probability = params.get('ransac_stop_probability', self.default_ransac_stop_probability)
+        self._ransac_min_nhit = params.get('ransac_min_nhit', self.default_ransac_min_nhit)
+        self._ransac_collinear_ratio = params.get('ransac_collinear_ratio', self.default_ransac_collinear_ratio)
         self.max_iterations = params.get('max_iterations', self.default_max_iterations)
         self.max_nhit = params.get('max_nhit', self.default_max_nhit)
+        self.use_gpu_dbscan = params.get('use_gpu_dbscan', self.default_use_gpu_dbscan)
+        self.gpu_dbscan_min_nhit = params.get('gpu_dbscan_min_nhit', self.default_gpu_dbscan_min_nhit)
+        if self.use_gpu_dbscan and cuml is None:
+            logging.warning('cupy and cuml are required for GPU DBSCAN, falling back to CPU')
+            self.use_gpu_dbscan = False
 
         self.trajectory_pts = params.get('trajectory_pts', self.default_trajectory_pts)
         self.trajectory_dx = params.get('trajectory_dx', self.default_trajectory_dx)
         self.tracklet_dtype = self.tracklet_dtype(self.trajectory_pts)
 
-        self.dbscan = cluster.DBSCAN(eps=self._dbscan_eps, min_samples=self._dbscan_min_samples)
+        self._dbscan_fn = make_dbscan_kernel(self._dbscan_min_samples)
+        self._ransac_fn = make_line_ransac_kernel(self._ransac_min_samples,
+                                                  self._ransac_residual_threshold,
+                                                  self._ransac_max_trials,
+                                                  self._ransac_stop_inlier_frac,
+                                                  self._ransac_stop_probability)
 
     def init(self, source_name):
         super(TrackletReconstruction, self).init(source_name)
@@ -119,8 +334,14 @@ class TrackletReconstruction(H5FlowStage):
                                     ransac_min_samples=self._ransac_min_samples,
                                     ransac_residual_threshold=self._ransac_residual_threshold,
                                     ransac_max_trials=self._ransac_max_trials,
+                                    ransac_stop_inlier_frac=self._ransac_stop_inlier_frac,
+                                    ransac_stop_probability=self._ransac_stop_probability,
+                                    ransac_min_nhit=self._ransac_min_nhit,
+                                    ransac_collinear_ratio=self._ransac_collinear_ratio,
                                     max_iterations=self.max_iterations,
                                     max_nhit=self.max_nhit,
+                                    use_gpu_dbscan=self.use_gpu_dbscan,
+                                    gpu_dbscan_min_nhit=self.gpu_dbscan_min_nhit,
                                     trajectory_pts=self.trajectory_pts,
                                     trajectory_dx=self.trajectory_dx
                                     )
@@ -142,9 +363,14 @@ class TrackletReconstruction(H5FlowStage):
             hit_drift = ma.array(hit_drift, mask=(events['nhit'][..., np.newaxis] > self.max_nhit) | hits['id'].mask,
                                  shrink=False)
 
-        track_ids = self.find_tracks(hits, hit_drift['z'])
-        tracks = self.calc_tracks(hits, hit_drift['z'], track_ids, self.trajectory_pts,
-                                  self.trajectory_dx)
+        hit_mask = ~hits['id'].mask
+        hit_offsets = self.hit_offsets(hit_mask)
+        hits = ma.getdata(hits)[hit_mask]
+        xyz = self.hit_xyz(hits, ma.getdata(hit_drift['z'])[hit_mask], dtype=np.float32)
+        hit_track_ids = self.find_tracks(xyz, hit_offsets)
+        tracks = self.calc_tracks(hits, xyz, hit_track_ids, hit_offsets,
+                                  self.trajectory_pts, self.trajectory_dx)
+
         n_tracks = np.count_nonzero(~tracks['id'].mask)
         tracks_mask = ~tracks['id'].mask
 
@@ -153,9 +379,11 @@ class TrackletReconstruction(H5FlowStage):
         self.data_manager.write_data(self.tracklet_dset_name, tracks_slice, tracks[tracks_mask])
 
         # track -> hit ref
-        track_ref_id = np.take_along_axis(tracks['id'], track_ids, axis=-1)
-        mask = (~track_ref_id.mask) & (track_ids != -1) & (~hits['id'].mask)
-        ref = np.c_[track_ref_id[mask], hits['id'][mask]]
+        hit_ev = np.repeat(np.arange(len(hit_offsets) - 1), np.diff(hit_offsets))
+        ref_idx = np.flatnonzero(hit_track_ids != -1)
+        ref_idx = ref_idx[tracks_mask[hit_ev[ref_idx], hit_track_ids[ref_idx]]]
+        ref = np.c_[ma.getdata(tracks['id'])[hit_ev[ref_idx], hit_track_ids[ref_idx]],
+                    hits['id'][ref_idx]]
         self.data_manager.write_ref(self.tracklet_dset_name, self.hits_dset_name, ref)
 
         # event -> track ref
@@ -164,81 +392,120 @@ class TrackletReconstruction(H5FlowStage):
         self.data_manager.write_ref(source_name, self.tracklet_dset_name, ref)
 
     @staticmethod
-    def hit_xyz(hits, hit_z):
-        xyz = np.concatenate((
-            np.expand_dims(hits['px'], axis=-1),
-            np.expand_dims(hits['py'], axis=-1),
-            np.expand_dims(hit_z, axis=-1),
-        ), axis=-1)
-        return xyz
-
-    def find_tracks(self, hits, hit_z):
+    def hit_xyz(hits, hit_z, dtype=np.float64):
         '''
-            Extract tracks from a given hits array
+            :param hits: array ``shape: (...,)``
 
-            :param hits: masked array ``shape: (N, n)``
+            :param hit_z: array ``shape: (...,)``
 
-            :param hit_z: masked array ``shape: (N, n)``
+            :param dtype: output datatype
 
-            :returns: mask array ``shape: (N, n)`` of track ids for each hit, a value of -1 means no track is associated with the hit
+            :returns: array ``shape: (..., 3)`` of hit 3D positions (masked values are not valid)
         '''
-        xyz = self.hit_xyz(hits, hit_z)
+        xyz = np.empty(np.shape(hits) + (3,), dtype=dtype)
+        xyz[..., 0] = ma.getdata(hits['px'])
+        xyz[..., 1] = ma.getdata(hits['py'])
+        xyz[..., 2] = ma.getdata(hit_z)
+        return xyz
 
-        iter_mask = np.ones(hits.shape, dtype=bool)
-        iter_mask = iter_mask & (~hits['id'].mask)
-        track_id = np.full(hits.shape, -1, dtype='i8')
-        for i in range(hits.shape[0]):
+    @staticmethod
+    def hit_offsets(hit_mask):
+        '''
+            :param hit_mask: boolean array ``shape: (N, n)`` of valid hits (``True == valid``)
 
-            if not np.any(iter_mask[i]):
-                continue
+            :returns: array ``shape: (N+1,)`` of the index of the first hit of
+                each event in the compacted array ``arr[hit_mask]``
+        '''
+        return np.r_[0, np.cumsum(np.count_nonzero(hit_mask, axis=-1))]
 
-            current_track_id = -1
+    def find_tracks(self, xyz, hit_offsets):
+        '''
+            Extract tracks from a given hits array
 
-            for _ in range(self.max_iterations):
-                # dbscan to find clusters
-                track_ids = self._do_dbscan(xyz[i], iter_mask[i])
+            :param xyz: array ``shape: (K, 3)`` of valid hit 3D positions, contiguous by event
 
-                for id_ in np.unique(track_ids):
-                    if id_ == -1:
-                        continue
-                    mask = track_ids == id_
-                    if np.sum(mask) <= self._ransac_min_samples:
+            :param hit_offsets: array ``shape: (N+1,)`` of the index of the first hit of each event (see ``hit_offsets()``)
+
+            :returns: array ``shape: (K,)`` of track ids for each hit, a value of -1 means no track is associated with the hit
+        '''
+        n_ev = len(hit_offsets) - 1
+        hit_ev = np.repeat(np.arange(n_ev), np.diff(hit_offsets))
+
+        iter_mask = np.ones(len(xyz), dtype=bool)
+        dbscan_mask = np.empty(len(xyz), dtype=bool)
+        track_id = np.full(len(xyz), -1, dtype='i4')
+        current_track_id = np.full(n_ev, -1, dtype='i4')
+
+        # neighbor graph of all hits, shared by every dbscan pass
+        if self.use_gpu_dbscan and len(xyz) >= self.gpu_dbscan_min_nhit:
+            dbscan_data = dict(gpu_xyz=cp.asarray(xyz, dtype=cp.float64))
+        else:
+            dbscan_data = self.neighbor_graph(xyz, hit_ev, self._dbscan_eps)
+
+        active = np.diff(hit_offsets) > 0
+        for _ in range(self.max_iterations):
+            if not np.any(active):
+                break
+
+            # dbscan to find clusters (all events in a single pass)
+            np.logical_and(iter_mask, active[hit_ev], out=dbscan_mask)
+            group = np.where(dbscan_mask, hit_ev, -1)
+            track_ids = self._do_dbscan(dbscan_data, group)
+
+            cluster_ev = []
+            cluster_hit_idcs = []
+            group = np.full(len(xyz), -1, dtype='i8')
+            for i in np.flatnonzero(active):
+                ev_xyz = xyz[hit_offsets[i]:hit_offsets[i + 1]]
+                ev_track_ids = track_ids[hit_offsets[i]:hit_offsets[i + 1]]
+                for id_, nhit in zip(*_cluster_ids(ev_track_ids)):
+                    if nhit <= self._ransac_min_samples:
                         continue
+                    mask = ev_track_ids == id_
 
                     # ransac for collinear hits
-                    inliers = self._do_ransac(xyz[i], mask)
+                    inliers = self._do_ransac(ev_xyz, mask)
                     mask[mask] = inliers
 
                     if np.sum(mask) < 1:
                         continue
 
-                    # and a final dbscan for re-clustering
-                    final_track_ids = self._do_dbscan(xyz[i], mask)
+                    cluster_hit_idx = np.flatnonzero(mask) + hit_offsets[i]
+                    group[cluster_hit_idx] = len(cluster_ev)
+                    cluster_ev.append(i)
+                    cluster_hit_idcs.append(cluster_hit_idx)
 
-                    for id_ in np.unique(final_track_ids):
-                        if id_ == -1:
-                            continue
-                        mask = final_track_ids == id_
+            if len(cluster_ev):
+                # and a final dbscan for re-clustering (all clusters in a single pass)
+                final_track_ids = self._do_dbscan(dbscan_data, group)
 
-                        current_track_id += 1
-                        track_id[i, mask] = current_track_id
-                        iter_mask[i, mask] = False
+                for i, cluster_hit_idx in zip(cluster_ev, cluster_hit_idcs):
+                    cluster_track_ids = final_track_ids[cluster_hit_idx]
+                    for id_ in _cluster_ids(cluster_track_ids)[0]:
+                        mask = cluster_hit_idx[cluster_track_ids == id_]
 
-                if np.all(track_ids == -1) or not np.any(iter_mask[i]):
-                    break
+                        current_track_id[i] += 1
+                        track_id[mask] = current_track_id[i]
+                        iter_mask[mask] = False
+
+            active &= np.bincount(hit_ev[track_ids != -1], minlength=n_ev) > 0
+            active &= np.bincount(hit_ev[iter_mask], minlength=n_ev) > 0
 
-        return ma.array(track_id, mask=hits['id'].mask, shrink=False)
+        return track_id
 
     @classmethod
-    def calc_tracks(cls, hits, hit_z, track_ids, trajectory_pts, trajectory_dx):
+    def calc_tracks(cls, hits, xyz, track_ids, hit_offsets, trajectory_pts, trajectory_dx):
         '''
             Calculate track parameters from hits
 
-            :param hits: masked array, ``shape: (N,M)``
+            :param hits: array, ``shape: (K,)`` of valid hits, contiguous by event
 
-            :param hit_z: masked array, ``shape: (N,M)``
+            :param xyz: array, ``shape: (K,3)`` of hit 3D positions
 
-            :param track_ids: masked array, ``shape: (N,M)``
+            :param track_ids: array, ``shape: (K,)`` of track ids for each hit,
+                a value of -1 means no track is associated with the hit
+
+            :param hit_offsets: array, ``shape: (N+1,)`` of the index of the first hit of each event (see ``hit_offsets()``)
 
             :param trajectory_pts: int
 
@@ -246,73 +513,159 @@ class TrackletReconstruction(H5FlowStage):
 
             :returns: masked array, ``shape: (N,m)``
         '''
-        xyz = cls.hit_xyz(hits, hit_z)
+        n_ev = len(hit_offsets) - 1
+        hit_ev = np.repeat(np.arange(n_ev), np.diff(hit_offsets))
+        track_ids = np.asarray(track_ids)
 
-        n_tracks = np.clip(track_ids.max() + 1, 1, np.inf).astype(int) if np.count_nonzero(~track_ids.mask) \
-            else 1
-        tracks = np.empty((len(hits), n_tracks), dtype=cls.tracklet_dtype(trajectory_pts))
+        n_tracks = max(track_ids.max() + 1, 1) if len(track_ids) else 1
+        tracks = np.empty((n_ev, n_tracks), dtype=cls.tracklet_dtype(trajectory_pts))
         tracks_mask = np.ones(tracks.shape, dtype=bool)
-        for i in range(tracks.shape[0]):
-            for j in range(tracks.shape[1]):
-                mask = ((track_ids[i] == j) & (~track_ids.mask[i])
-                        & (~hits['id'].mask[i]))
-                if np.count_nonzero(mask) < 2:
-                    continue
 
-                # PCA on central hits
-                centroid, axis = cls.do_pca(xyz[i], mask)
-                r_min, r_max = cls.projected_limits(
-                    centroid, axis, xyz[i][mask])
-                residual = cls.track_residual(centroid, axis, xyz[i][mask])
-                xyp = cls.xyp(axis, centroid)
-
-                # run trajectory approximation algo
-                traj = cls.trajectory_approx(centroid, axis, xyz[i][mask],
-                                             npts=trajectory_pts, dx=trajectory_dx,
-                                             weights=hits[i][mask]['q'])  # (npts, 3)
-                d = cls.trajectory_residual(xyz[i][mask], traj)  # (npts-1, N)
-                min_edge_mask = np.indices(d.shape)[0] != np.expand_dims(np.argmin(d, axis=0), 0)  # (npts-1, N)
-                edge_q = ma.sum(ma.array(
-                    np.broadcast_to(hits[i][mask]['q'][np.newaxis, :],
-                                    min_edge_mask.shape),
-                    mask=min_edge_mask, shrink=False), axis=-1)  # (npts-1,)
-                edge_res = ma.mean(ma.array(d, mask=min_edge_mask,
-                                            shrink=False), axis=-1)  # (npts-1,)
-
-                tracks[i, j]['theta'] = cls.theta(axis)
-                tracks[i, j]['phi'] = cls.phi(axis)
-                tracks[i, j]['xp'] = xyp[0]
-                tracks[i, j]['yp'] = xyp[1]
-                tracks[i, j]['nhit'] = np.count_nonzero(mask)
-                tracks[i, j]['q'] = np.sum(hits[i][mask]['q'])
-                tracks[i, j]['ts_start'] = np.min(hits[i][mask]['ts'])
-                tracks[i, j]['ts_end'] = np.max(hits[i][mask]['ts'])
-                tracks[i, j]['residual'] = residual
-                tracks[i, j]['length'] = np.linalg.norm(r_max - r_min)
-                tracks[i, j]['start'] = r_min
-                tracks[i, j]['end'] = r_max
-
-                tracks[i, j]['trajectory'] = traj
-                tracks[i, j]['trajectory_residual'] = edge_res
-                tracks[i, j]['dx'] = np.diff(traj, axis=0)
-                tracks[i, j]['dq'] = edge_q
-                tracks[i, j]['dn'] = np.sum(~min_edge_mask, axis=-1)
-
-                tracks_mask[i, j] = False
+        # group hits by (event, track), keeping the original hit order within each group
+        hit_sel = np.flatnonzero(track_ids >= 0)
+        hit_grp = hit_ev[hit_sel] * n_tracks + track_ids[hit_sel]
+        order = np.argsort(hit_grp, kind='stable')
+        hit_sel, hit_grp = hit_sel[order], hit_grp[order]
+        grp, grp_start, grp_nhit = np.unique(hit_grp, return_index=True, return_counts=True)
+
+        if len(grp):
+            hit_q = hits['q'][hit_sel]
+            hit_ts = hits['ts'][hit_sel]
+            grp_q = np.add.reduceat(hit_q, grp_start)
+            grp_ts_start = np.minimum.reduceat(hit_ts, grp_start)
+            grp_ts_end = np.maximum.reduceat(hit_ts, grp_start)
+
+            # PCA on central hits
+            hit_xyz = xyz[hit_sel].astype(np.float64)
+            grp_centroid, grp_axis = cls.do_batched_pca(hit_xyz, grp_start)
+            grp_r_min, grp_r_max, grp_residual, grp_xyp = cls.batched_track_stats(
+                hit_xyz, grp_start, grp_centroid, grp_axis)
+
+            grp_mask = grp_nhit >= 2
+            i, j = np.divmod(grp[grp_mask], n_tracks)
+            tracks['theta'][i, j] = cls.theta(grp_axis[grp_mask])
+            tracks['phi'][i, j] = cls.phi(grp_axis[grp_mask])
+            tracks['xp'][i, j] = grp_xyp[grp_mask, 0]
+            tracks['yp'][i, j] = grp_xyp[grp_mask, 1]
+            tracks['nhit'][i, j] = grp_nhit[grp_mask]
+            tracks['q'][i, j] = grp_q[grp_mask]
+            tracks['ts_start'][i, j] = grp_ts_start[grp_mask]
+            tracks['ts_end'][i, j] = grp_ts_end[grp_mask]
+            tracks['residual'][i, j] = grp_residual[grp_mask]
+            tracks['length'][i, j] = np.linalg.norm(grp_r_max[grp_mask] - grp_r_min[grp_mask], axis=-1)
+            tracks['start'][i, j] = grp_r_min[grp_mask]
+            tracks['end'][i, j] = grp_r_max[grp_mask]
+            tracks_mask[i, j] = False
+
+        for g in np.flatnonzero(grp_nhit >= 2):
+            i, j = divmod(grp[g], n_tracks)
+            grp_slice = slice(grp_start[g], grp_start[g] + grp_nhit[g])
+            track_xyz = hit_xyz[grp_slice]
+            track_q = hit_q[grp_slice]
+            centroid, axis = grp_centroid[g], grp_axis[g]
+
+            # run trajectory approximation algo
+            traj = cls.trajectory_approx(centroid, axis, track_xyz,
+                                         npts=trajectory_pts, dx=trajectory_dx,
+                                         weights=track_q)  # (npts, 3)
+            d = cls.trajectory_residual(track_xyz, traj)  # (npts-1, N)
+            min_edge_mask = np.indices(d.shape)[0] != np.expand_dims(np.argmin(d, axis=0), 0)  # (npts-1, N)
+            edge_q = ma.sum(ma.array(
+                np.broadcast_to(track_q[np.newaxis, :],
+                                min_edge_mask.shape),
+                mask=min_edge_mask, shrink=False), axis=-1)  # (npts-1,)
+            edge_res = ma.mean(ma.array(d, mask=min_edge_mask,
+                                        shrink=False), axis=-1)  # (npts-1,)
+
+            tracks[i, j]['trajectory'] = traj
+            tracks[i, j]['trajectory_residual'] = edge_res
+            tracks[i, j]['dx'] = np.diff(traj, axis=0)
+            tracks[i, j]['dq'] = edge_q
+            tracks[i, j]['dn'] = np.sum(~min_edge_mask, axis=-1)
 
         return ma.array(tracks, mask=tracks_mask, shrink=False)
 
-    def _do_dbscan(self, xyz, mask):
+    @staticmethod
+    def neighbor_graph(xyz, hit_ev, eps):
         '''
-            :param xyz: ``shape: (N,3)`` array of precomputed 3D distances
+            Finds all pairs of positions within ``eps`` of each other
+            using a single KD-tree. Each event is displaced along the x-axis
+            so that positions from different events are never neighbors.
+            Neighbors are independent of the input order, so the graph can be
+            used for DBSCAN in the original order.
 
-            :param mask: ``shape: (N,)`` boolean array of valid positions (``True == valid``)
+            :param xyz: ``shape: (n, 3)`` array of 3D positions
+
+            :param hit_ev: ``shape: (n,)`` event index of each position
+
+            :param eps: ``float``, max distance between neighbors
+
+            :returns: ``dict`` of CSR index pointer ``indptr``, ``shape: (n+1,)``,
+                and indices ``indices``, ``shape: (E,)``, of the neighbor graph
+        '''
+        pts = np.array(xyz, dtype=np.float64)
+        if len(pts):
+            pts[:, 0] += hit_ev * (3 * eps + np.ptp(pts[:, 0]))
+
+        # build tree from positions sorted by z (within each event) for better
+        # memory locality, then map pairs back to the original positions
+        order = np.lexsort((pts[:, 2], hit_ev))
+        pairs = order[cKDTree(pts[order]).query_pairs(eps, output_type='ndarray')]
+        i = np.r_[pairs[:, 0], pairs[:, 1]].astype('i8')
+        j = np.r_[pairs[:, 1], pairs[:, 0]].astype('i8')
+
+        indptr = np.r_[0, np.cumsum(np.bincount(i, minlength=len(pts)))].astype('i8')
+        indices = j[np.argsort(i, kind='stable')]
+        return dict(indptr=indptr, indices=indices)
+
+    def _do_dbscan(self, dbscan_data, group):
+        '''
+            :param dbscan_data: ``dict`` with either the ``indptr`` and
+                ``indices`` of the ``dbscan_eps`` neighbor graph, or the
+                ``gpu_xyz`` device array of 3D positions
+
+            :param group: ``shape: (n,)`` independent group index of each position, ``-1`` to exclude the position
+
+            :returns: ``shape: (n,)`` array of grouped track ids (numbered from 0
+                within each group), a value of -1 means the position was not clustered
+        '''
+        if 'gpu_xyz' in dbscan_data:
+            return self._do_gpu_dbscan(dbscan_data['gpu_xyz'], group)
+        return self._dbscan_fn(dbscan_data['indptr'], dbscan_data['indices'], group.astype('i8'))
+
+    def _do_gpu_dbscan(self, gpu_xyz, group):
+        '''
+            Runs a single ``cuml`` DBSCAN fit over all groups. Each group is
+            displaced along the x-axis so that positions from different groups
+            are never within ``dbscan_eps`` of each other.
+
+            :param gpu_xyz: ``shape: (n,3)`` device array of 3D positions
 
-            :returns: ``shape: (N,)`` array of grouped track ids
+            :param group: ``shape: (n,)`` independent group index of each position, ``-1`` to exclude the position
+
+            :returns: ``shape: (n,)`` array of grouped track ids (numbered from 0
+                within each group), a value of -1 means the position was not clustered
         '''
-        clustering = self.dbscan.fit(xyz[mask])
-        track_ids = np.full(len(mask), -1)
-        track_ids[mask] = clustering.labels_
+        track_ids = np.full(len(group), -1, dtype='i8')
+        sel = np.flatnonzero(group != -1)
+        if not len(sel):
+            return track_ids
+
+        pts = gpu_xyz[cp.asarray(sel)]
+        pts[:, 0] += cp.asarray(group[sel]) * (3 * self._dbscan_eps + float(cp.ptp(gpu_xyz[:, 0])))
+        labels = cp.asnumpy(cuml.cluster.DBSCAN(eps=self._dbscan_eps, min_samples=self._dbscan_min_samples)
+                            .fit_predict(pts)).astype('i8')
+
+        # number clusters within each group by their first position
+        clustered = labels != -1
+        _, first_idx, inv = np.unique(labels[clustered], return_index=True, return_inverse=True)
+        cluster_group = group[sel][clustered][first_idx]
+        order = np.lexsort((first_idx, cluster_group))
+        cluster_label = np.empty(len(order), dtype='i8')
+        cluster_label[order] = np.arange(len(order)) - np.searchsorted(cluster_group[order], cluster_group[order])
+
+        labels[clustered] = cluster_label[inv]
+        track_ids[sel] = labels
         return track_ids
 
     def _do_ransac(self, xyz, mask):
@@ -323,11 +676,17 @@ class TrackletReconstruction(H5FlowStage):
 
             :returns: ``shape: (N,)`` boolean array of colinear positions
         '''
-        model_robust, inliers = ransac(xyz[mask], LineModelND,
-                                       min_samples=self._ransac_min_samples,
-                                       residual_threshold=self._ransac_residual_threshold,
-                                       max_trials=self._ransac_max_trials)
-        return inliers
+        pts = np.asarray(xyz)[mask].astype(np.float64)
+
+        # skip random trials for small, already collinear, or coincident clusters
+        d = pts - np.mean(pts, axis=0)
+        w, v = np.linalg.eigh(d.T @ d)
+        if len(pts) < self._ransac_min_nhit or w[-1] >= self._ransac_collinear_ratio * (w[0] + w[1]):
+            axis = v[:, -1]
+            res = np.linalg.norm(d - np.outer(d @ axis, axis), axis=-1)
+            return res < self._ransac_residual_threshold
+
+        return self._ransac_fn(pts)
 
     @staticmethod
     def trajectory_approx(centroid, axis, xyz, npts, dx, weights=None):
@@ -403,36 +762,66 @@ class TrackletReconstruction(H5FlowStage):
         return traj
 
     @staticmethod
-    def do_pca(xyz, mask):
+    def do_batched_pca(xyz, grp_start):
         '''
-            :param xyz: ``shape: (N,3)`` array of 3D positions
+            :param xyz: ``shape: (N,3)`` array of 3D positions, sorted into contiguous groups
 
-            :param mask: ``shape: (N,)`` boolean array of valid positions (``True == valid``)
+            :param grp_start: ``shape: (G,)`` index of the first position in each group
 
-            :returns: ``tuple`` of ``shape: (3,)``, ``shape: (3,)`` of centroid and central axis
+            :returns: ``tuple`` of ``shape: (G,3)``, ``shape: (G,3)`` of centroid and central axis of each group
         '''
-        centroid = np.mean(xyz[mask], axis=0)
-        pca = dcomp.PCA(n_components=1).fit(xyz[mask] - centroid)
-        axis = pca.components_[0] / np.linalg.norm(pca.components_[0])
+        grp_nhit = np.diff(np.r_[grp_start, len(xyz)])
+        centroid = np.add.reduceat(xyz, grp_start, axis=0) / grp_nhit[:, np.newaxis]
+        d = xyz - np.repeat(centroid, grp_nhit, axis=0)
+        cov = np.add.reduceat(np.einsum('ni,nj->nij', d, d), grp_start, axis=0)  # (G,3,3)
+
+        # principal axis is the eigenvector with the largest eigenvalue
+        _, v = np.linalg.eigh(cov)
+        axis = v[..., -1]
 
         # break degenerate pca axis direction by fixing y component to be negative
-        if axis[1] > 0:
-            axis = -axis
+        axis[axis[:, 1] > 0] *= -1
         return centroid, axis
 
     @staticmethod
-    def projected_limits(centroid, axis, xyz):
-        s = np.dot((xyz - centroid), axis)
-        xyz_min, xyz_max = np.amin(xyz, axis=0), np.amax(xyz, axis=0)
-        r_max = np.clip(centroid + axis * np.max(s), xyz_min, xyz_max)
-        r_min = np.clip(centroid + axis * np.min(s), xyz_min, xyz_max)
-        return r_min, r_max
+    def batched_track_stats(xyz, grp_start, centroid, axis):
+        '''
+            Calculates the projected limits, average residual, and ``x=0,y=0``
+            plane intersection of each group in a single pass over the
+            positions.
 
-    @staticmethod
-    def track_residual(centroid, axis, xyz):
-        s = np.dot((xyz - centroid), axis)
-        res = np.abs(xyz - (centroid + np.outer(s, axis)))
-        return np.mean(res, axis=0)
+            :param xyz: ``shape: (N,3)`` array of 3D positions, sorted into contiguous groups
+
+            :param grp_start: ``shape: (G,)`` index of the first position in each group
+
+            :param centroid: ``shape: (G,3)`` pre-calculated centroid of each group
+
+            :param axis: ``shape: (G,3)`` pre-calculated PCA of each group
+
+            :returns: ``tuple`` of ``shape: (G,3)``, ``shape: (G,3)``,
+                ``shape: (G,3)``, ``shape: (G,2)`` of track start, track end,
+                average residual, and ``x,y`` intersection point
+        '''
+        grp_nhit = np.diff(np.r_[grp_start, len(xyz)])
+        hit_axis = np.repeat(axis, grp_nhit, axis=0)
+        d = xyz - np.repeat(centroid, grp_nhit, axis=0)
+        s = np.sum(d * hit_axis, axis=-1)
+
+        xyz_min = np.minimum.reduceat(xyz, grp_start, axis=0)
+        xyz_max = np.maximum.reduceat(xyz, grp_start, axis=0)
+        s_min = np.minimum.reduceat(s, grp_start)[:, np.newaxis]
+        s_max = np.maximum.reduceat(s, grp_start)[:, np.newaxis]
+        r_min = np.clip(centroid + axis * s_min, xyz_min, xyz_max)
+        r_max = np.clip(centroid + axis * s_max, xyz_min, xyz_max)
+
+        residual = np.add.reduceat(np.abs(d - s[:, np.newaxis] * hit_axis), grp_start, axis=0) \
+            / grp_nhit[:, np.newaxis]
+
+        # tracks parallel to the anode use the centroid
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s_p = np.where(axis[:, -1:] == 0, 0, -centroid[:, -1:] / axis[:, -1:])
+        xyp = (centroid + axis * s_p)[:, :2]
+        return r_min, r_max, residual, xyp
 
     @staticmethod
     def trajectory_residual(xyz, traj):
@@ -461,31 +850,17 @@ class TrackletReconstruction(H5FlowStage):
     @staticmethod
     def theta(axis):
         '''
-            :param axis: array, ``shape: (3,)``
+            :param axis: array, ``shape: (..., 3)``
 
             :returns: angle of axis w.r.t z-axis
         '''
-        return np.arctan2(np.linalg.norm(axis[:2]), axis[-1])
+        return np.arctan2(np.linalg.norm(axis[..., :2], axis=-1), axis[..., -1])
 
     @staticmethod
     def phi(axis):
         '''
-            :param axis: array, ``shape: (3,)``
+            :param axis: array, ``shape: (..., 3)``
 
             :returns: orientation of axis about z-axis
         '''
-        return np.arctan2(axis[1], axis[0])
-
-    @staticmethod
-    def xyp(axis, centroid):
-        '''
-            :param axis: array, ``shape: (3,)``
-
-            :param centroid: array, ``shape: (3,)``
-
-            :returns: x,y coordinate where line intersects ``x=0,y=0`` plane
-        '''
-        if axis[-1] == 0:
-            return centroid[:2]
-        s = -centroid[-1] / axis[-1]
-        return (centroid + axis * s)[:2]
+        return np.arctan2(axis[..., 1], axis[..., 0])
@@ -20,8 +20,8 @@ setuptools.setup(name='module0_flow',
                      'h5py>=2.10',
                      'pytest',
                      'scipy',
-                     'scikit-image',
                      'scikit-learn',
+                     'numba',
                      'h5flow>=0.1.0'
                  ]
                  )
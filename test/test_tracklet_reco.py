@@ -0,0 +1,263 @@
+import warnings
+
+import numpy as np
+import numpy.ma as ma
+import numba as nb
+from sklearn.cluster import DBSCAN
+
+from module0_flow.reco.combined.tracklet_reco import (TrackletReconstruction,
+                                                      make_dbscan_kernel,
+                                                      make_line_ransac_kernel)
+
+
+@nb.njit
+def seed_numba(seed):
+    np.random.seed(seed)
+
+
+def tracklet_reco(**params):
+    return TrackletReconstruction(name='tracklet_reco', classname='TrackletReconstruction',
+                                  data_manager=None, **params)
+
+
+def test_neighbor_graph():
+    eps = 25
+    rng = np.random.default_rng(0)
+    hit_ev = np.sort(rng.integers(0, 3, 200))
+    xyz = rng.uniform(0, 100, (200, 3))
+    graph = TrackletReconstruction.neighbor_graph(xyz, hit_ev, eps)
+
+    # compare to brute-force neighbors within each event, excluding self
+    d = np.linalg.norm(xyz[:, np.newaxis] - xyz[np.newaxis, :], axis=-1)
+    expected = (d <= eps) & (hit_ev[:, np.newaxis] == hit_ev[np.newaxis, :])
+    np.fill_diagonal(expected, False)
+    assert np.all(np.diff(graph['indptr']) == np.sum(expected, axis=-1))
+    for i in range(len(xyz)):
+        neighbors = graph['indices'][graph['indptr'][i]:graph['indptr'][i + 1]]
+        assert np.all(np.sort(neighbors) == np.flatnonzero(expected[i]))
+
+
+def test_dbscan_graph():
+    eps, min_samples = 25, 5
+    dbscan = make_dbscan_kernel(min_samples)
+    rng = np.random.default_rng(0)
+    for _ in range(10):
+        nev = rng.integers(1, 5)
+        hit_ev = np.sort(rng.integers(0, nev, 300))
+        xyz = rng.uniform(0, 100, (300, 3))
+
+        # group hits by event, excluding some positions
+        group = hit_ev.copy()
+        group[rng.uniform(size=len(group)) < 0.1] = -1
+
+        graph = TrackletReconstruction.neighbor_graph(xyz, hit_ev, eps)
+        labels = dbscan(graph['indptr'], graph['indices'], group)
+
+        assert np.all(labels[group == -1] == -1)
+        for ev in range(nev):
+            mask = group == ev
+            if not np.any(mask):
+                continue
+            expected = DBSCAN(eps=eps, min_samples=min_samples).fit(xyz[mask]).labels_
+            assert np.all(labels[mask] == expected)
+
+
+def test_line_ransac():
+    ransac = make_line_ransac_kernel(min_samples=2, residual_threshold=8,
+                                     max_trials=100)
+    seed_numba(0)
+    rng = np.random.default_rng(0)
+    s = rng.uniform(-100, 100, (100, 1))
+    line = s * np.array([[0.6, 0.0, 0.8]]) + rng.normal(0, 0.5, (100, 3))
+    outliers = rng.uniform(-100, 100, (20, 3))
+    outliers[:, 1] = rng.choice([-1, 1], 20) * rng.uniform(20, 100, 20)
+    inliers = ransac(np.r_[line, outliers])
+
+    assert np.sum(inliers[:100]) >= 90
+    assert not np.any(inliers[100:])
+
+
+def test_line_ransac_degenerate():
+    ransac = make_line_ransac_kernel(min_samples=2, residual_threshold=8,
+                                     max_trials=100)
+
+    # identical positions are all inliers of a zero-direction trial
+    assert np.all(ransac(np.ones((10, 3))))
+
+    xyz = np.linspace(0, 100, 20)[:, np.newaxis] * np.array([[1., 2., 3.]])
+    assert np.all(ransac(xyz))
+
+
+def test_line_ransac_scattered():
+    ransac = make_line_ransac_kernel(min_samples=8, residual_threshold=2,
+                                     max_trials=100)
+    seed_numba(0)
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        # no line through scattered positions has more than a few inliers
+        xyz = rng.uniform(0, 200, (300, 3))
+        inliers = ransac(xyz)
+        assert inliers.shape == (300,)
+        assert 0 < np.sum(inliers) <= 10
+
+
+def test_find_tracks_coincident():
+    reco = tracklet_reco()
+    xyz = np.full((10, 3), 50, dtype=np.float32)
+    track_ids = reco.find_tracks(xyz, np.array([0, 10]))
+    assert np.all(track_ids == 0)
+
+
+def test_calc_tracks():
+    # two events, hits of two tracks interleaved in the first event
+    xyz = np.zeros((8, 3))
+    xyz[:, 0] = [0, 0, 10, 10, 20, 20, 0, 10]
+    xyz[:, 1] = [0, 50, 0, 50, 0, 50, 0, 0]
+    hits = np.zeros(8, dtype=[('q', 'f8'), ('ts', 'f8')])
+    hits['q'] = np.arange(8) + 1
+    hits['ts'] = [5, 1, 6, 2, 7, 3, 0, 0]
+    track_ids = np.array([0, 1, 0, 1, 0, 1, 0, -1])
+    hit_offsets = np.array([0, 6, 6, 8])
+
+    tracks = TrackletReconstruction.calc_tracks(hits, xyz, track_ids, hit_offsets,
+                                                trajectory_pts=5, trajectory_dx=10)
+    assert tracks.shape == (3, 2)
+
+    # empty event and single-hit tracks are masked
+    assert np.all(tracks['id'].mask == np.array([[False, False], [True, True], [True, True]]))
+    assert np.all(tracks['nhit'][0] == [3, 3])
+    assert np.allclose(tracks['q'][0], [1 + 3 + 5, 2 + 4 + 6])
+    assert np.allclose(tracks['ts_start'][0], [5, 1])
+    assert np.allclose(tracks['ts_end'][0], [7, 3])
+    assert np.allclose(tracks['length'][0], [20, 20])
+    assert np.allclose(tracks['start'][0, 0], [0, 0, 0])
+    assert np.allclose(tracks['end'][0, 1], [20, 50, 0])
+
+
+def test_do_batched_pca():
+    rng = np.random.default_rng(0)
+    axis = np.array([[1., 2., 2.], [0., 0., 1.]]) / np.array([[3.], [1.]])
+    xyz = np.r_[
+        rng.uniform(-50, 50, (20, 1)) * axis[0] + [10, 20, 30],
+        rng.uniform(-50, 50, (30, 1)) * axis[1] + [-10, 0, 5],
+    ]
+    grp_start = np.array([0, 20])
+
+    centroid, pca_axis = TrackletReconstruction.do_batched_pca(xyz, grp_start)
+    assert np.allclose(centroid[0], np.mean(xyz[:20], axis=0))
+    assert np.allclose(centroid[1], np.mean(xyz[20:], axis=0))
+    assert np.allclose(np.abs(np.sum(pca_axis * axis, axis=-1)), 1)
+    assert np.allclose(np.linalg.norm(pca_axis, axis=-1), 1)
+
+    # degenerate direction is fixed by a non-positive y component
+    assert np.all(pca_axis[:, 1] <= 0)
+
+
+def test_batched_track_stats():
+    # track crossing z=0 at (-4, 2), and a track parallel to the anode with
+    # hits displaced by +-1 in z
+    s = np.linspace(-10, 10, 5)[:, np.newaxis]
+    axis = np.array([[0.6, 0., 0.8], [1., 0., 0.]])
+    centroid = np.array([[2., 2., 8.], [0., 5., 20.]])
+    xyz = np.r_[
+        centroid[0] + s * axis[0],
+        centroid[1] + s * axis[1] + np.array([[0, 0, 1], [0, 0, -1]] * 2 + [[0, 0, 0]]),
+    ]
+    grp_start = np.array([0, 5])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        r_min, r_max, residual, xyp = TrackletReconstruction.batched_track_stats(
+            xyz, grp_start, centroid, axis)
+
+    assert np.allclose(r_min, [centroid[0] - 10 * axis[0], [-10, 5, 20]])
+    assert np.allclose(r_max, [centroid[0] + 10 * axis[0], [10, 5, 20]])
+    assert np.allclose(residual, [[0, 0, 0], [0, 0, 0.8]])
+    assert np.allclose(xyp, [[-4, 2], [0, 5]])
+
+
+def line_xyz(start, end, n):
+    return np.linspace(start, end, n)
+
+
+def test_find_tracks():
+    # two tracks in the first event, an empty event, and a track with an
+    # isolated hit in the last event
+    xyz = np.r_[
+        line_xyz([0, 0, 0], [100, 0, 50], 30),
+        line_xyz([0, 200, 0], [0, 200, 100], 30),
+        line_xyz([-50, -50, 10], [50, 50, 10], 40),
+        [[300, 300, 300]],
+    ].astype(np.float32)
+    hit_offsets = np.array([0, 60, 60, 101])
+
+    reco = tracklet_reco()
+    track_ids = reco.find_tracks(xyz, hit_offsets)
+    assert track_ids.shape == (101,)
+    assert track_ids[-1] == -1
+    for sl in (slice(0, 30), slice(30, 60), slice(60, 100)):
+        assert np.all(track_ids[sl] == track_ids[sl][0])
+    assert set(track_ids[:60]) == {0, 1}
+    assert track_ids[60] == 0
+
+    hits = np.zeros(len(xyz), dtype=[('q', 'f8'), ('ts', 'f8')])
+    tracks = reco.calc_tracks(hits, xyz, track_ids, hit_offsets,
+                              reco.trajectory_pts, reco.trajectory_dx)
+    assert tracks.shape == (3, 2)
+    assert np.all(tracks['id'].mask == np.array([[False, False], [True, True], [False, True]]))
+    assert np.all(tracks['nhit'][[0, 0, 2], [0, 1, 0]] == [30, 30, 40])
+    assert np.allclose(np.sort(tracks['length'][0]), [100, np.hypot(100, 50)], atol=1e-3)
+    assert np.isclose(tracks['length'][2, 0], np.hypot(100, 100), atol=1e-3)
+
+
+class DataManager(object):
+    def __init__(self):
+        self.data = dict()
+        self.refs = dict()
+
+    def reserve_data(self, dset_name, n):
+        start = sum(len(d) for d in self.data.get(dset_name, []))
+        return slice(start, start + n)
+
+    def write_data(self, dset_name, sl, data):
+        self.data.setdefault(dset_name, []).append(np.asarray(data))
+
+    def write_ref(self, parent_dset_name, child_dset_name, ref):
+        self.refs[(parent_dset_name, child_dset_name)] = np.asarray(ref)
+
+
+def test_run_refs():
+    # two events, each with a track and an isolated hit
+    xyz = [
+        np.r_[line_xyz([0, 0, 0], [100, 0, 0], 20), [[300, 300, 300]]],
+        np.r_[[[300, 300, 300]], line_xyz([0, 0, 50], [0, 100, 50], 10)],
+    ]
+    hits = ma.masked_all((2, 21), dtype=[('id', 'u4'), ('px', 'f8'), ('py', 'f8'), ('ts', 'f8'), ('q', 'f8')])
+    hit_drift = ma.masked_all((2, 21, 1), dtype=[('z', 'f8')])
+    hit_id = 0
+    for i, ev_xyz in enumerate(xyz):
+        n = len(ev_xyz)
+        hits['id'][i, :n] = np.arange(hit_id, hit_id + n)
+        hits['px'][i, :n] = ev_xyz[:, 0]
+        hits['py'][i, :n] = ev_xyz[:, 1]
+        hits['ts'][i, :n] = 0
+        hits['q'][i, :n] = 1
+        hit_drift['z'][i, :n, 0] = ev_xyz[:, 2]
+        hit_id += n
+    events = np.array([(21,), (11,)], dtype=[('nhit', 'i8')])
+
+    reco = tracklet_reco(hits_dset_name='hits', hit_drift_dset_name='hit_drift',
+                         tracklet_dset_name='tracklets')
+    reco.data_manager = DataManager()
+    reco.run('events', slice(10, 12), {'events': events, 'hits': hits, 'hit_drift': hit_drift})
+
+    tracks = np.concatenate(reco.data_manager.data['tracklets'])
+    assert np.all(tracks['id'] == [0, 1])
+    assert np.all(tracks['nhit'] == [20, 10])
+
+    ev_ref = reco.data_manager.refs[('events', 'tracklets')]
+    assert np.all(ev_ref == [[10, 0], [11, 1]])
+
+    hit_ref = reco.data_manager.refs[('tracklets', 'hits')]
+    assert np.all(hit_ref[:, 0] == np.r_[np.zeros(20), np.ones(10)])
+    assert np.all(hit_ref[:, 1] == np.r_[np.arange(20), np.arange(22, 32)])